@@ -1,13 +1,18 @@
 # backtest_dashboard_refined.py
 import sqlite3
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.graph_objects as go
 import plotly.express as px
+import xlsxwriter
 import io
 import re
 from datetime import datetime
 import zipfile, os
+from utils.kernels import (WIN_TABLE, _simulate_kernel, arredondar_odds,
+                           market_resolution)
+from utils.mercados import encode_market, encode_markets
 
 if not os.path.exists("banco_test.db") and os.path.exists("banco_test.zip"):
     with zipfile.ZipFile("banco_test.zip", "r") as zip_ref:
@@ -26,203 +31,234 @@ st.title("⚽ Backtest Plataforma — Versão refinada")
 # --------------------------
 
 
-@st.cache_data(ttl=3600)
-def load_raw_tables(db_path=DB_PATH):
-    """Carrega tabelas 'jogos' e 'odds' do banco. Retorna dois DataFrames."""
+# chaveada pela versão do banco: se o coletor substituir o arquivo, a conexão
+# antiga (presa ao arquivo removido) sai do cache junto com os dados
+@st.cache_resource(max_entries=2)
+def get_conn(db_path=DB_PATH, db_versao=None):
+    """Conexão SQLite somente leitura, aberta uma vez por versão do banco e
+       compartilhada entre sessões/threads (page cache e mmap continuam quentes).
+       Sem cache=shared: nesse modo uma conexão nova reaproveitaria o pager da
+       antiga e continuaria lendo o arquivo substituído.
+       É um recurso compartilhado: não fechar nem alterar (sem commit/PRAGMA de escrita).
+       O app nunca escreve no banco: os índices vêm do mock_database.py/coletor, e
+       mode=ro falha (em vez de criar um arquivo vazio) quando o banco não existe."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True,
+                           check_same_thread=False)
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+def db_mtime(db_path=DB_PATH):
+    """Versão do banco (mtime do arquivo). Entra nas chaves dos caches para que uma
+       carga nova do coletor invalide o que foi persistido em disco."""
+    try:
+        return os.path.getmtime(db_path)
+    except OSError:
+        return 0.0
+
+
+def parquet_atualizado(path, db_path=DB_PATH):
+    """True se o parquet existe e é mais novo que o banco (pode pular o SQLite)."""
+    try:
+        return os.path.getmtime(path) >= db_mtime(db_path)
+    except OSError:
+        return False
+
+
+# persist="disk": o resultado sobrevive a reinícios do servidor (o Streamlit ignora
+# ttl com persist, por isso a validade vem do mtime do banco na chave)
+@st.cache_data(persist="disk", max_entries=4)
+def load_filter_options(db_path=DB_PATH, db_versao=None):
+    """Retorna as ligas, temporadas e mercados disponíveis no banco."""
     try:
-        conn = sqlite3.connect(db_path)
+        conn = get_conn(db_path, db_versao)
     except Exception as e:
         st.error(f"Erro abrindo banco {db_path}: {e}")
-        return pd.DataFrame(), pd.DataFrame()
+        return [], [], []
 
     try:
-        df_jogos = pd.read_sql_query(
-            "SELECT * FROM jogos", conn, parse_dates=["data"])
+        ligas = [r[0] for r in conn.execute(
+            "SELECT DISTINCT liga_nome FROM jogos WHERE liga_nome IS NOT NULL ORDER BY liga_nome")]
+        anos = [r[0] for r in conn.execute(
+            "SELECT DISTINCT temporada FROM jogos WHERE temporada IS NOT NULL ORDER BY temporada")]
+        mercados = [r[0] for r in conn.execute(
+            "SELECT DISTINCT mercado FROM odds WHERE mercado IS NOT NULL ORDER BY mercado")]
     except Exception:
-        df_jogos = pd.DataFrame()
+        ligas, anos, mercados = [], [], []
+
+    return ligas, anos, mercados
+
+
+# agregação das odds por jogo/mercado, resolvida no próprio SQLite
+ODDS_AGG_SQL = {"max": "MAX", "mean": "AVG"}
+
+# colunas de jogo carregadas do banco (as odds vêm do cache largo)
+JOGO_COLS = ["id_jogo", "liga_nome", "temporada", "data", "mandante", "visitante",
+             "gols_mandante", "gols_visitante"]
+
 
+# versão do formato do parquet largo: incrementar ao mudar a consulta, o pivot ou
+# os dtypes, para que arquivos gerados pelo código antigo não sejam reaproveitados
+ODDS_WIDE_VERSAO = 2
+
+
+def odds_wide_path(agg="max", db_path=DB_PATH):
+    """Caminho do parquet com as odds em formato largo, ao lado do banco. A versão
+       do formato faz parte do nome."""
+    return f"{os.path.splitext(db_path)[0]}_odds_wide_{agg}_v{ODDS_WIDE_VERSAO}.parquet"
+
+
+@st.cache_data(ttl=3600, max_entries=2)
+def load_odds_wide(agg="max", db_path=DB_PATH, db_versao=None):
+    """Odds em formato largo: uma linha por id_jogo e uma coluna float32 por mercado
+       (odd agregada entre bookmakers). Materializado em parquet, que é refeito
+       quando o banco fica mais novo que ele ou quando ODDS_WIDE_VERSAO muda."""
+    path = odds_wide_path(agg, db_path)
+    if parquet_atualizado(path, db_path):
+        try:
+            return pd.read_parquet(path)
+        except Exception:
+            pass  # parquet inválido: reconstrói a partir do banco
+
+    try:
+        conn = get_conn(db_path, db_versao)
+    except Exception as e:
+        st.error(f"Erro abrindo banco {db_path}: {e}")
+        return pd.DataFrame()
+
+    query = f"""
+        SELECT id_jogo, mercado, {ODDS_AGG_SQL.get(agg, "MAX")}(odd) AS odd
+        FROM odds
+        WHERE mercado IS NOT NULL
+        GROUP BY id_jogo, mercado
+    """
     try:
-        df_odds = pd.read_sql_query("SELECT * FROM odds", conn)
+        df_long = pd.read_sql_query(query, conn)
     except Exception:
-        df_odds = pd.DataFrame()
+        df_long = pd.DataFrame()
 
-    conn.close()
-    return df_jogos, df_odds
+    if df_long.empty:
+        return pd.DataFrame()
 
+    # (id_jogo, mercado) já é único após o GROUP BY: pivot direto
+    pivot = df_long.pivot(index="id_jogo", columns="mercado",
+                          values="odd").astype(np.float32)
+    pivot.columns.name = None
+    try:
+        pivot.to_parquet(path, engine="pyarrow")
+    except Exception:
+        pass  # sem permissão de escrita: segue só com o cache em memória
+    return pivot
 
-def aggregate_odds(df_odds: pd.DataFrame, method="max"):
-    """Agrupa odds por id_jogo e mercado."""
-    if df_odds.empty:
-        return df_odds
-    df_odds = df_odds.copy()
-    if "odd" in df_odds.columns:
-        df_odds["odd"] = pd.to_numeric(df_odds["odd"], errors="coerce")
-        df_odds = df_odds.dropna(subset=["odd"])
-    else:
-        return pd.DataFrame()  # sem odds válidas
 
-    # garantir coluna 'mercado' e 'id_jogo' exista
-    if not {"id_jogo", "mercado"}.issubset(df_odds.columns):
+@st.cache_data(persist="disk", max_entries=4)
+def load_jogos(ligas, anos, db_path=DB_PATH, db_versao=None):
+    """Jogos das ligas/temporadas escolhidas, filtrados no banco.
+       Recebe tuplas (chave do cache)."""
+    if not ligas or not anos:
+        return pd.DataFrame()
+    try:
+        conn = get_conn(db_path, db_versao)
+    except Exception as e:
+        st.error(f"Erro abrindo banco {db_path}: {e}")
         return pd.DataFrame()
 
-    if method == "max":
-        agg = df_odds.groupby(["id_jogo", "mercado"],
-                              as_index=False)["odd"].max()
-    else:
-        agg = df_odds.groupby(["id_jogo", "mercado"],
-                              as_index=False)["odd"].mean()
-    return agg
+    def placeholders(values):
+        return ", ".join("?" * len(values))
+
+    # ORDER BY: a ordem das linhas (e portanto o desempate de jogos na mesma data)
+    # não pode depender do plano de consulta/índices disponíveis
+    query = f"""
+        SELECT {", ".join(JOGO_COLS)}
+        FROM jogos
+        WHERE liga_nome IN ({placeholders(ligas)})
+          AND temporada IN ({placeholders(anos)})
+        ORDER BY id_jogo
+    """
+    try:
+        df = pd.read_sql_query(query, conn, params=[*ligas, *anos])
+    except Exception:
+        df = pd.DataFrame()
+
+    if not df.empty:
+        # única conversão de 'data' (ISO do SQLite -> datetime64[ns, UTC]); o frame
+        # em cache já sai tipado e ninguém mais precisa reconverter
+        df["data"] = pd.to_datetime(df["data"], utc=True, format="ISO8601",
+                                    errors="coerce", cache=True)
+        # tipos estreitos: gols cabem em int8 (ausente conta como 0), temporada em int16
+        df["gols_mandante"] = df["gols_mandante"].fillna(0).astype(np.int8)
+        df["gols_visitante"] = df["gols_visitante"].fillna(0).astype(np.int8)
+        df["temporada"] = df["temporada"].astype(np.int16)
+        # textos de baixa cardinalidade como category: comparações e agrupamentos
+        # operam nos códigos inteiros em vez de hashear strings Python
+        for col in ("liga_nome", "mandante", "visitante"):
+            df[col] = df[col].astype("category")
+    return df
 
-# --------------------------
-# Parsing de mercados (robusto)
-# --------------------------
 
+@st.cache_data(ttl=3600)
+def load_market_codes(mercados):
+    """Códigos (int8/float32) dos mercados do banco, calculados uma vez por
+       conjunto de rótulos: nenhum regex roda durante a simulação. Fica só em
+       memória: os códigos dependem do parser (utils/mercados.py), não do banco,
+       e codificar algumas dezenas de rótulos custa microssegundos."""
+    return encode_markets(mercados)
+
+
+@st.cache_data(ttl=3600, max_entries=4)
+def load_filtered(ligas, anos, mercados, agg="max", db_path=DB_PATH, db_versao=None):
+    """Jogos filtrados + uma coluna de odd por mercado escolhido, alinhada por
+       id_jogo. Jogos sem odd em nenhum dos mercados ficam de fora.
+       Cache limitado: reruns com os mesmos filtros não refazem reindex/concat."""
+    df_jogos = load_jogos(ligas, anos, db_path, db_versao)
+    odds_wide = load_odds_wide(agg, db_path, db_versao)
+    if df_jogos.empty or odds_wide.empty:
+        return pd.DataFrame()
 
-def parse_market_label(mercado_label: str):
-    m = mercado_label or ""
-    if "Over/Under" in m or "Over" in m and "/" in m:
-        match = re.search(r"(Over|Under)\s*([0-9]+(?:\.[0-9]+)?)", m)
-        if match:
-            return {"type": "over_under", "side": match.group(1), "limit": float(match.group(2))}
-    if "Both Teams" in m or "Both Teams to Score" in m or m.upper().startswith("BTTS"):
-        match = re.search(r"(Yes|No)", m, re.IGNORECASE)
-        side = match.group(1).capitalize() if match else None
-        return {"type": "btts", "side": side}
-    if "Match Winner" in m or "1X2" in m or "Match" in m:
-        if re.search(r"Home", m, re.IGNORECASE):
-            return {"type": "match_winner", "side": "Home"}
-        if re.search(r"Away", m, re.IGNORECASE):
-            return {"type": "match_winner", "side": "Away"}
-        if re.search(r"Draw", m, re.IGNORECASE):
-            return {"type": "match_winner", "side": "Draw"}
-    return {"type": "unknown", "label": m}
+    # filtrar mercados é só selecionar colunas
+    cols = [m for m in mercados if m in odds_wide.columns]
+    if not cols:
+        return pd.DataFrame()
+    odds_sel = odds_wide.reindex(index=df_jogos["id_jogo"].to_numpy(), columns=cols)
+    df = pd.concat([df_jogos, odds_sel.reset_index(drop=True)], axis=1)
+    return df.dropna(subset=cols, how="all").reset_index(drop=True)
 
 # --------------------------
 # Simulação (core)
 # --------------------------
 
 
-def simulate_strategy(df: pd.DataFrame, mercado_label: str, stake=100,
-                      odd_min=1.01, odd_max=10.0, initial_bank=0.0):
-    """Recebe df (já contendo colunas de jogo e 'odd' e 'mercado' correspondente),
-       aplica filtros de odds, simula lucro por aposta e retorna df_result + metrics."""
-    if df is None or df.empty:
-        return pd.DataFrame(), {}
-
-    # copiar e garantir tipos
-    df = df.copy()
-    if "data" in df.columns:
-        df["data"] = pd.to_datetime(df["data"], utc=True, errors="coerce")
-    # Filtrar por odd disponível
-    df["odd"] = pd.to_numeric(df["odd"], errors="coerce")
-    df = df.dropna(subset=["odd"])
-
-    # aplicar bound de odds
-    df = df[(df["odd"] >= odd_min) & (df["odd"] <= odd_max)].copy()
-    if df.empty:
-        return pd.DataFrame(), {}
-
-    # ordenar por data (importante para curvas)
-    if "data" in df.columns:
-        df = df.sort_values("data").reset_index(drop=True)
-    else:
-        df = df.reset_index(drop=True)
-
-    parsed = parse_market_label(mercado_label)
-
-    lucros = []
-    wins = 0
-    losses = 0
-    total_staked = 0.0
-    bets_placed = 0
-
-    for _, row in df.iterrows():
-        odd = float(row["odd"])
-        gols_home = int(row.get("gols_mandante") or 0)
-        gols_away = int(row.get("gols_visitante") or 0)
-        gols = gols_home + gols_away
-
-        lucro = 0.0
-        bet_placed = False
-
-        if parsed["type"] == "over_under":
-            limit = parsed.get("limit", 0.0)
-            side = parsed.get("side")
-            bet_placed = True
-            if side == "Over":
-                # Over se gols > limite (ex: Over 2.5 => >=3)
-                if gols > limit:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-            else:  # Under
-                # Under se gols <= limite
-                if gols <= limit:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-
-        elif parsed["type"] == "btts":
-            side = parsed.get("side")
-            bet_placed = True
-            if side == "Yes":
-                if gols_home > 0 and gols_away > 0:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-            else:  # No
-                if gols_home == 0 or gols_away == 0:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-
-        elif parsed["type"] == "match_winner":
-            side = parsed.get("side")
-            bet_placed = True
-            if side == "Home":
-                if gols_home > gols_away:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-            elif side == "Away":
-                if gols_away > gols_home:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-            else:  # Draw
-                if gols_home == gols_away:
-                    lucro = (odd - 1) * stake
-                else:
-                    lucro = -stake
-
-        else:
-            bet_placed = False
-            lucro = 0.0
-
-        if bet_placed:
-            total_staked += stake
-            bets_placed += 1
-            if lucro > 0:
-                wins += 1
-            else:
-                losses += 1
+def resolve_market(odd, gols_home, gols_away, type_code, side_code, limit,
+                   stake=100, initial_bank=0.0):
+    """Resolve as apostas de um mercado (já codificado) sobre arrays alinhados.
+       Retorna (lucro, banca, drawdown, wins, losses, total_staked)."""
+    code, linha = market_resolution(type_code, side_code, limit)
+    if code < 0:
+        # mercado não reconhecido: nenhuma aposta realizada
+        return (np.zeros(len(odd)), np.full(len(odd), float(initial_bank)),
+                np.zeros(len(odd)), 0, 0, 0.0)
 
-        lucros.append(lucro)
+    lucro, banca, drawdown, wins, losses = _simulate_kernel(
+        odd, gols_home, gols_away, WIN_TABLE, code, linha, float(stake),
+        float(initial_bank))
+    return lucro, banca, drawdown, wins, losses, float(stake * len(lucro))
 
-    df["lucro"] = lucros
-    df["banca"] = df["lucro"].cumsum() + initial_bank
 
-    lucro_final = df["lucro"].sum()
-    total_apostas = int((df["lucro"] != 0).sum())
+def market_metrics(mercado_label, odd, lucro, drawdown, wins, losses, total_staked):
+    """Métricas agregadas de um mercado a partir dos arrays simulados."""
+    # lucro vem em centavos exatos; o arredondamento tira o resíduo da soma em float
+    lucro_final = round(float(lucro.sum(dtype=np.float64)), 2)
+    total_apostas = int((lucro != 0).sum())
     roi = (lucro_final / total_staked) if total_staked > 0 else 0.0
     taxa_acerto = (wins / (wins + losses)) if (wins + losses) > 0 else None
-    dd_series = calc_drawdown_series(df["banca"])
-    max_drawdown = float(dd_series.min()) if not dd_series.empty else 0.0
-    avg_odd = float(df["odd"].mean()) if not df["odd"].empty else None
+    max_drawdown = float(drawdown.min()) if len(drawdown) else 0.0
+    avg_odd = float(odd.mean(dtype=np.float64)) if len(odd) else None
 
-    metrics = {
+    return {
         "mercado": mercado_label,
-        "registros": int(len(df)),
+        "registros": int(len(odd)),
         "apostas_realizadas": int(total_apostas),
         "lucro_final": float(lucro_final),
         "total_staked": float(total_staked),
@@ -231,23 +267,16 @@ def simulate_strategy(df: pd.DataFrame, mercado_label: str, stake=100,
         "max_drawdown": float(max_drawdown),
         "avg_odd": float(avg_odd) if avg_odd is not None else None
     }
-    return df, metrics
-
-
-def calc_drawdown_series(banca_series: pd.Series):
-    if banca_series.empty:
-        return pd.Series(dtype=float)
-    running_max = banca_series.cummax()
-    drawdown = banca_series - running_max
-    return drawdown
 
 
 # --------------------------
 # UI / Interação
 # --------------------------
-df_jogos, df_odds = load_raw_tables()
+db_versao = db_mtime()
+ligas_available, anos_available, mercados_available = load_filter_options(
+    db_versao=db_versao)
 
-if df_jogos.empty or df_odds.empty:
+if not ligas_available or not anos_available or not mercados_available:
     st.warning(
         "Banco vazio ou não encontrado. Rode o script de coleta para popular 'banco_test.db'.")
     st.stop()
@@ -256,27 +285,10 @@ if df_jogos.empty or df_odds.empty:
 agg_method = st.sidebar.selectbox(
     "Como agregar múltiplas odds por jogo/mercado?", ["max (melhor odd)", "mean (média)"])
 agg_method_key = "max" if agg_method.startswith("max") else "mean"
-df_odds_agg = aggregate_odds(df_odds, method=agg_method_key)
-
-# montar DF combinado: apenas combina id_jogo -> traz liga/nome/temporada
-df_combined = df_odds_agg.merge(
-    df_jogos, how="left", left_on="id_jogo", right_on="id_jogo")
-
-# normalizar colunas mínimas
-if "data" in df_combined.columns:
-    df_combined["data"] = pd.to_datetime(
-        df_combined["data"], utc=True, errors="coerce")
 
 # --------------------------
 # Filtros com defaults seguros  # >>> CORREÇÃO
 # --------------------------
-ligas_available = sorted(df_combined["liga_nome"].dropna(
-).unique()) if "liga_nome" in df_combined.columns else []
-anos_available = sorted(df_combined["temporada"].dropna(
-).unique()) if "temporada" in df_combined.columns else []
-mercados_available = sorted(df_combined["mercado"].dropna(
-).unique()) if "mercado" in df_combined.columns else []
-
 ligas_sel = st.sidebar.multiselect(
     "Ligas", options=ligas_available, default=ligas_available[:5] if ligas_available else [])
 anos_sel = st.sidebar.multiselect(
@@ -299,11 +311,10 @@ if not mercados_sel or not ligas_sel or not anos_sel:
         "Escolha pelo menos uma liga, uma temporada e um mercado para rodar o backtest.")
     st.stop()
 
-df_filtered = df_combined[
-    df_combined["liga_nome"].isin(ligas_sel) &
-    df_combined["temporada"].isin(anos_sel) &
-    df_combined["mercado"].isin(mercados_sel)
-].copy()
+# jogos filtrados no SQLite + colunas de odd (formato largo) por mercado
+df_filtered = load_filtered(tuple(sorted(ligas_sel)), tuple(sorted(anos_sel)),
+                            tuple(sorted(mercados_sel)), agg_method_key,
+                            db_versao=db_versao)
 
 if df_filtered.empty:
     st.warning("Não há dados com os filtros selecionados.")
@@ -312,32 +323,73 @@ if df_filtered.empty:
 # --------------------------
 # Rodar simulações (por mercado)
 # --------------------------
-with st.spinner("Rodando backtests..."):
+# Chaves esperadas para garantir consistência (>>> CORREÇÃO)
+expected_metric_keys = ["mercado", "registros", "apostas_realizadas",
+                        "lucro_final", "total_staked", "roi", "taxa_acerto",
+                        "max_drawdown", "avg_odd"]
+
+
+def run_backtests(df_filtered, mercados_sel, market_codes, stake, odd_min, odd_max,
+                  initial_bank):
+    """Simula todos os mercados escolhidos.
+       Retorna (results_metrics, market_curves, market_drawdowns, market_dfs)."""
     results_metrics = []
     market_curves = {}
     market_drawdowns = {}
     market_dfs = {}
 
-    # Chaves esperadas para garantir consistência (>>> CORREÇÃO)
-    expected_metric_keys = ["mercado", "registros", "apostas_realizadas",
-                            "lucro_final", "total_staked", "roi", "taxa_acerto",
-                            "max_drawdown", "avg_odd"]
+    # ordem cronológica como array de índices (NaT no fim): o df_filtered não é
+    # reordenado nem copiado; colunas de jogo e gols são extraídas uma única vez
+    order = df_filtered["data"].array.argsort(kind="stable")
+    gols_home_all = df_filtered["gols_mandante"].to_numpy(np.int8)
+    gols_away_all = df_filtered["gols_visitante"].to_numpy(np.int8)
+    jogo_arrays = {c: df_filtered[c].array for c in JOGO_COLS}
+    # códigos pré-calculados na carga; rótulo fora do cache é codificado na hora
+    # (itertuples preserva cada coluna; .loc[m] leria a linha como Series em float)
+    codes_by_market = {
+        row.Index: (int(row.market_type_code), int(row.market_side_code),
+                    float(row.market_limit))
+        for row in market_codes.itertuples()}
+    for m in mercados_sel:
+        if m not in codes_by_market:
+            codes_by_market[m] = encode_market(m)
 
     for market in mercados_sel:
-        df_market = df_filtered[df_filtered["mercado"] == market].copy()
-        df_res, metrics = simulate_strategy(df_market, market, stake=stake,
-                                            odd_min=odd_min, odd_max=odd_max,
-                                            initial_bank=initial_bank)
-        if df_res is not None and not df_res.empty:
+        if market in df_filtered.columns:
+            odd_ord = df_filtered[market].to_numpy(np.float32)[order]
+        else:
+            odd_ord = np.empty(0, dtype=np.float32)
+        # bound de odds (NaN cai fora nas duas comparações); rows fica em ordem de data
+        keep = (odd_ord >= odd_min) & (odd_ord <= odd_max)
+        rows = order[keep] if len(odd_ord) else order[:0]
+
+        df_res = pd.DataFrame()
+        if len(rows):
+            # float32 só no armazenamento: conta e saída usam a odd cotada
+            odd = arredondar_odds(odd_ord[keep])
+            lucro, banca, drawdown, wins, losses, total_staked = resolve_market(
+                odd, gols_home_all[rows], gols_away_all[rows],
+                *codes_by_market[market], stake=stake, initial_bank=initial_bank)
+            # frame de saída montado uma única vez a partir dos arrays
+            df_res = pd.DataFrame({
+                **{c: arr.take(rows) for c, arr in jogo_arrays.items()},
+                "mercado": market,
+                "odd": odd,
+                "lucro": lucro,
+                "banca": banca,
+                "drawdown": drawdown,
+            })
+            metrics = market_metrics(market, odd, lucro, drawdown,
+                                     wins, losses, total_staked)
+        if not df_res.empty:
             # padronizar keys caso falte alguma
             for k in expected_metric_keys:
                 if k not in metrics:
                     metrics[k] = 0.0 if k not in (
                         "mercado", "taxa_acerto") else None
             results_metrics.append(metrics)
-            market_curves[market] = df_res[["data", "banca"]].copy()
-            market_drawdowns[market] = calc_drawdown_series(
-                df_res["banca"]).reset_index(drop=True)
+            market_curves[market] = df_res[["data", "banca"]]
+            market_drawdowns[market] = df_res["drawdown"]
             market_dfs[market] = df_res
         else:
             # mesmo que vazia, incluir métrica informativa (mesmas chaves)  >>> CORREÇÃO
@@ -353,6 +405,21 @@ with st.spinner("Rodando backtests..."):
                 "avg_odd": None
             })
 
+    return results_metrics, market_curves, market_drawdowns, market_dfs
+
+
+# resultado memorizado na sessão: reruns que não mudam filtros/parâmetros da
+# simulação (ex.: interação dentro de um fragmento, download) não resimulam
+sim_key = (tuple(sorted(ligas_sel)), tuple(sorted(anos_sel)), tuple(mercados_sel),
+           agg_method_key, stake, odd_min, odd_max, initial_bank, db_versao)
+if st.session_state.get("sim_key") != sim_key:
+    with st.spinner("Rodando backtests..."):
+        st.session_state["sim_result"] = run_backtests(
+            df_filtered, mercados_sel, load_market_codes(tuple(mercados_available)),
+            stake, odd_min, odd_max, initial_bank)
+        st.session_state["sim_key"] = sim_key
+results_metrics, market_curves, market_drawdowns, market_dfs = st.session_state["sim_result"]
+
 # --------------------------
 # Tabela de métricas (blindada)  >>> CORREÇÃO
 # --------------------------
@@ -378,130 +445,222 @@ else:
 # --------------------------
 # Curva de Banca
 # --------------------------
-st.subheader("📈 Curva de Banca (comparativa)")
-fig = go.Figure()
-for market, curve in market_curves.items():
-    if curve is None or curve.empty:
-        continue
-    x = curve["data"]
-    y = curve["banca"]
-    fig.add_trace(go.Scatter(x=x, y=y, mode="lines+markers",
-                  name=market, hovertemplate="%{x}<br>Banca: %{y:.2f}"))
-fig.update_layout(yaxis_title="Banca", xaxis_title="Data",
-                  legend_title="Mercado", height=450)
-st.plotly_chart(fig, use_container_width=True)
+
+
+def render_banca_curve(market_curves):
+    st.subheader("📈 Curva de Banca (comparativa)")
+    fig = go.Figure()
+    for market, curve in market_curves.items():
+        if curve is None or curve.empty:
+            continue
+        x = curve["data"]
+        y = curve["banca"]
+        fig.add_trace(go.Scatter(x=x, y=y, mode="lines+markers",
+                      name=market, hovertemplate="%{x}<br>Banca: %{y:.2f}"))
+    fig.update_layout(yaxis_title="Banca", xaxis_title="Data",
+                      legend_title="Mercado", height=450)
+    st.plotly_chart(fig, use_container_width=True)
+
+
+render_banca_curve(market_curves)
 
 # --------------------------
 # Drawdown
 # --------------------------
-st.subheader("📉 Drawdown (comparado)")
-fig_dd = go.Figure()
-for market, df_market in market_dfs.items():
-    if df_market is None or df_market.empty:
-        continue
-    dd = calc_drawdown_series(df_market["banca"])
-    fig_dd.add_trace(go.Scatter(
-        x=df_market["data"], y=dd, fill='tozeroy', name=market, hovertemplate="%{x}<br>Drawdown: %{y:.2f}"))
-fig_dd.update_layout(yaxis_title="Drawdown", xaxis_title="Data", height=350)
-st.plotly_chart(fig_dd, use_container_width=True)
+
+
+def render_drawdown(market_dfs):
+    st.subheader("📉 Drawdown (comparado)")
+    fig_dd = go.Figure()
+    for market, df_market in market_dfs.items():
+        if df_market is None or df_market.empty:
+            continue
+        # drawdown já calculado pelo kernel junto com a banca
+        dd = df_market["drawdown"]
+        fig_dd.add_trace(go.Scatter(
+            x=df_market["data"], y=dd, fill='tozeroy', name=market, hovertemplate="%{x}<br>Drawdown: %{y:.2f}"))
+    fig_dd.update_layout(yaxis_title="Drawdown", xaxis_title="Data", height=350)
+    st.plotly_chart(fig_dd, use_container_width=True)
+
+
+render_drawdown(market_dfs)
 
 # --------------------------
 # Novos comparativos
 # --------------------------
+
 # Boxplot de odds (proteção caso não exista coluna)
-st.subheader("📊 Distribuição de odds por mercado")
-if "odd" in df_filtered.columns:
-    fig_box = px.box(df_filtered, x="mercado", y="odd", points="all",
-                     title="Distribuição das odds por mercado")
-    st.plotly_chart(fig_box, use_container_width=True)
-else:
-    st.info("Coluna 'odd' não encontrada para plotar a distribuição.")
+def render_odds_box(df_filtered, mercados_sel):
+    st.subheader("📊 Distribuição de odds por mercado")
+    odd_cols = [m for m in mercados_sel if m in df_filtered.columns]
+    if odd_cols:
+        # formato longo só para o gráfico
+        df_box = df_filtered[odd_cols].melt(
+            var_name="mercado", value_name="odd").dropna(subset=["odd"])
+        fig_box = px.box(df_box, x="mercado", y="odd", points="all",
+                         title="Distribuição das odds por mercado")
+        st.plotly_chart(fig_box, use_container_width=True)
+    else:
+        st.info("Coluna 'odd' não encontrada para plotar a distribuição.")
+
+
+render_odds_box(df_filtered, mercados_sel)
+
 
 # ROI por mercado (garantido que df_metrics tem 'roi' e 'mercado')
-st.subheader("💹 ROI por mercado")
-if not df_metrics.empty and "roi" in df_metrics.columns and "mercado" in df_metrics.columns:
-    # transformar NaNs para 0 para visual
-    df_metrics["roi_display"] = df_metrics["roi"].fillna(0.0).astype(float)
-    fig_roi = px.bar(df_metrics, x="mercado", y="roi_display",
-                     text="roi_display", title="ROI (%) por mercado")
-    fig_roi.update_traces(texttemplate="%{text:.2%}", textposition="outside")
-    fig_roi.update_layout(yaxis_tickformat=".0%")
-    st.plotly_chart(fig_roi, use_container_width=True)
-else:
-    st.info("Não há dados suficientes para calcular ROI.")
+def render_roi(df_metrics):
+    st.subheader("💹 ROI por mercado")
+    if not df_metrics.empty and "roi" in df_metrics.columns and "mercado" in df_metrics.columns:
+        # transformar NaNs para 0 para visual
+        df_metrics["roi_display"] = df_metrics["roi"].fillna(0.0).astype(float)
+        fig_roi = px.bar(df_metrics, x="mercado", y="roi_display",
+                         text="roi_display", title="ROI (%) por mercado")
+        fig_roi.update_traces(texttemplate="%{text:.2%}", textposition="outside")
+        fig_roi.update_layout(yaxis_tickformat=".0%")
+        st.plotly_chart(fig_roi, use_container_width=True)
+    else:
+        st.info("Não há dados suficientes para calcular ROI.")
+
+
+render_roi(df_metrics)
+
 
 # Heatmap de lucro por liga e mercado (>>> CORREÇÃO: usar market_dfs que contém 'lucro')
-st.subheader("🔥 Heatmap de lucro por liga e mercado")
-# construir pivot a partir de market_dfs
-heatmap_frames = []
-for market, df_m in market_dfs.items():
-    if df_m is None or df_m.empty:
-        continue
-    if "liga_nome" not in df_m.columns or "lucro" not in df_m.columns:
-        continue
-    s = df_m.groupby("liga_nome")["lucro"].sum().rename(market)
-    heatmap_frames.append(s)
-
-if heatmap_frames:
-    pivot = pd.concat(heatmap_frames, axis=1).fillna(0)
-    # garantir index/columns ordenados
-    pivot = pivot.sort_index()
-    fig_heat = px.imshow(pivot, text_auto=".2f",
-                         labels=dict(x="Mercado", y="Liga", color="Lucro"),
-                         aspect="auto")
-    st.plotly_chart(fig_heat, use_container_width=True)
-else:
-    st.info("Não há dados suficientes (ou coluna 'lucro' ausente) para gerar o heatmap.")
+def render_heatmap(market_dfs):
+    st.subheader("🔥 Heatmap de lucro por liga e mercado")
+    # construir a matriz (liga x mercado) numa única passada sobre os arrays de
+    # market_dfs, sem groupby/concat por mercado
+    # liga_nome já é category (load_jogos) e todos os market_dfs saem do mesmo
+    # df_filtered, então compartilham as categorias: os códigos indexam direto
+    mercados_heat, codes_parts, lucro_parts = [], [], []
+    categorias = None
+    for market, df_m in market_dfs.items():
+        if df_m is None or df_m.empty:
+            continue
+        if "liga_nome" not in df_m.columns or "lucro" not in df_m.columns:
+            continue
+        mercados_heat.append(market)
+        categorias = df_m["liga_nome"].cat.categories
+        codes_parts.append(df_m["liga_nome"].cat.codes.to_numpy())
+        lucro_parts.append(df_m["lucro"].to_numpy(dtype=np.float64))
+
+    if mercados_heat:
+        liga_codes = np.concatenate(codes_parts)
+        market_idx = np.repeat(np.arange(len(mercados_heat)),
+                               [len(x) for x in lucro_parts])
+        validos = liga_codes >= 0  # liga ausente (código -1) fica de fora, como no groupby
+        mat = np.zeros((len(categorias), len(mercados_heat)), dtype=np.float64)
+        np.add.at(mat, (liga_codes[validos], market_idx[validos]),
+                  np.concatenate(lucro_parts)[validos])
+        # só ligas com apostas; categorias ordenadas -> linhas em ordem alfabética
+        presentes = np.zeros(len(categorias), dtype=bool)
+        presentes[liga_codes[validos]] = True
+        pivot = pd.DataFrame(mat[presentes], index=categorias[presentes],
+                             columns=mercados_heat)
+        fig_heat = px.imshow(pivot, text_auto=".2f",
+                             labels=dict(x="Mercado", y="Liga", color="Lucro"),
+                             aspect="auto")
+        st.plotly_chart(fig_heat, use_container_width=True)
+    else:
+        st.info("Não há dados suficientes (ou coluna 'lucro' ausente) para gerar o heatmap.")
+
+
+render_heatmap(market_dfs)
 
 # --------------------------
 # Tabela detalhada e export
 # --------------------------
-st.subheader("📋 Detalhes das apostas")
-# >>> CORREÇÃO: proteção
-first_market = mercados_sel[0] if mercados_sel else None
-
-if first_market and market_dfs.get(first_market) is not None and not market_dfs[first_market].empty:
-    st.write(f"Mostrando detalhes para: **{first_market}**")
-    cols_show = ["data", "liga_nome", "temporada", "mandante",
-                 "visitante", "mercado", "odd", "lucro", "banca"]
-    available_cols = [
-        c for c in cols_show if c in market_dfs[first_market].columns]
-    st.dataframe(market_dfs[first_market].loc[:, available_cols].sort_values(
-        "data").reset_index(drop=True))
-else:
-    st.info("Nenhum detalhe disponível para o mercado selecionado.")
+
+
+@st.fragment
+def render_details(market_dfs, mercados_sel):
+    st.subheader("📋 Detalhes das apostas")
+    # trocar o mercado reexecuta só este fragmento
+    market_show = st.selectbox("Mercado (detalhes)", options=list(mercados_sel))
+
+    if market_show and market_dfs.get(market_show) is not None and not market_dfs[market_show].empty:
+        st.write(f"Mostrando detalhes para: **{market_show}**")
+        cols_show = ["data", "liga_nome", "temporada", "mandante",
+                     "visitante", "mercado", "odd", "lucro", "banca"]
+        available_cols = [
+            c for c in cols_show if c in market_dfs[market_show].columns]
+        st.dataframe(market_dfs[market_show].loc[:, available_cols].sort_values(
+            "data").reset_index(drop=True))
+    else:
+        st.info("Nenhum detalhe disponível para o mercado selecionado.")
+
+
+render_details(market_dfs, mercados_sel)
+
+
+# caracteres que o Excel não aceita em nomes de aba (ex.: "Over/Under 2.5 - Over")
+_SHEET_NAME_INVALID_RE = re.compile(r"[\[\]:*?/\\]")
+
+
+def _excel_columns(df: pd.DataFrame):
+    """Converte cada coluna uma única vez para valores que o xlsxwriter grava direto:
+       datas sem fuso (o Excel não guarda fuso), texto como str e ausentes como None."""
+    columns = []
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.DatetimeTZDtype):
+            s = s.dt.tz_convert("UTC").dt.tz_localize(None)
+        missing = s.isna().to_numpy()
+        if not (pd.api.types.is_numeric_dtype(s) or pd.api.types.is_datetime64_any_dtype(s)):
+            s = s.astype(str)
+        columns.append(np.where(missing, None, s.astype(object).to_numpy()))
+    return columns
 
 
 def to_excel_bytes(dict_of_dfs):
-    """Recebe dict {sheet_name: df} e retorna bytes do arquivo xlsx."""
+    """Recebe dict {sheet_name: df} e retorna bytes do arquivo xlsx.
+       xlsxwriter em constant_memory descarrega cada linha ao passar para a seguinte,
+       por isso a escrita é linha a linha (df.to_excel preenche coluna a coluna e
+       perderia dados nesse modo)."""
     output = io.BytesIO()
-    # tentar engines comuns
-    try:
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            for name, df in dict_of_dfs.items():
-                df.to_excel(writer, sheet_name=str(name)[:31], index=False)
-    except Exception:
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            for name, df in dict_of_dfs.items():
-                df.to_excel(writer, sheet_name=str(name)[:31], index=False)
-    output.seek(0)
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True,
+                                            "default_date_format": "yyyy-mm-dd hh:mm"})
+    for name, df in dict_of_dfs.items():
+        worksheet = workbook.add_worksheet(
+            _SHEET_NAME_INVALID_RE.sub("-", str(name))[:31])
+        worksheet.write_row(0, 0, [str(c) for c in df.columns])
+        for row_idx, row in enumerate(zip(*_excel_columns(df)), start=1):
+            worksheet.write_row(row_idx, 0, row)
+    workbook.close()
     return output.getvalue()
 
 
-# preparar pacotes para download
-csv_all = pd.DataFrame(results_metrics).to_csv(index=False).encode("utf-8")
-st.download_button("Baixar métricas (CSV)", data=csv_all,
-                   file_name="metrics_backtest.csv", mime="text/csv")
+def export_bytes(sim_key, results_metrics, market_dfs):
+    """(csv, xlsx) do resultado, gerados uma vez por simulação: memorizados na sessão
+       com a mesma chave do resultado, reruns sem mudança não refazem o Excel.
+       xlsx é None quando nenhum mercado tem apostas."""
+    if st.session_state.get("export_key") != sim_key:
+        csv_all = pd.DataFrame(results_metrics).to_csv(index=False).encode("utf-8")
+        # Excel com uma aba por mercado (detalhes) — só se houver dados
+        market_dfs_nonempty = {
+            m: market_dfs[m] for m in market_dfs if market_dfs[m] is not None and not market_dfs[m].empty}
+        excel_bytes = to_excel_bytes(market_dfs_nonempty) if market_dfs_nonempty else None
+        st.session_state["export_result"] = (csv_all, excel_bytes)
+        st.session_state["export_key"] = sim_key
+    return st.session_state["export_result"]
+
+
+# downloads num fragmento: o clique reexecuta só esta parte
+@st.fragment
+def render_exports(sim_key, results_metrics, market_dfs):
+    # preparar pacotes para download
+    csv_all, excel_bytes = export_bytes(sim_key, results_metrics, market_dfs)
+    st.download_button("Baixar métricas (CSV)", data=csv_all,
+                       file_name="metrics_backtest.csv", mime="text/csv")
+
+    if excel_bytes is not None:
+        st.download_button("Baixar detalhes por mercado (Excel)", data=excel_bytes, file_name="detalhes_backtest.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    else:
+        st.info("Nenhum detalhe de apostas para exportar (nenhum mercado com dados).")
 
-# Excel com uma aba por mercado (detalhes) — só se houver dados
-market_dfs_nonempty = {m: market_dfs[m].fillna(
-    "") for m in market_dfs if market_dfs[m] is not None and not market_dfs[m].empty}
-if market_dfs_nonempty:
-    excel_bytes = to_excel_bytes(market_dfs_nonempty)
-    st.download_button("Baixar detalhes por mercado (Excel)", data=excel_bytes, file_name="detalhes_backtest.xlsx",
-                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-else:
-    st.info("Nenhum detalhe de apostas para exportar (nenhum mercado com dados).")
+
+render_exports(sim_key, results_metrics, market_dfs)
 
 st.info("Dica: use a opção 'max (melhor odd)' se quiser simular com a melhor odd disponível entre bookmakers (backtest mais otimista).")
 
@@ -45,14 +45,16 @@ MERCADOS = {
     "Total Goals": ["0-1", "2-3", "4+"],
 }
 
-BOOKMAKERS = ["Bet365", "Betfair", "Pinnacle", "1xBet"]
-
 # --------------------------
 # Setup banco
 # --------------------------
 conn = sqlite3.connect(DB_PATH)
 c = conn.cursor()
 
+# Banco descartável: sem fsync nem journal em disco durante a geração
+c.execute("PRAGMA synchronous=OFF")
+c.execute("PRAGMA journal_mode=MEMORY")
+
 # Resetar tabelas
 c.execute("DROP TABLE IF EXISTS odds")
 c.execute("DROP TABLE IF EXISTS jogos")
@@ -75,8 +77,7 @@ CREATE TABLE IF NOT EXISTS odds (
     id_odd INTEGER PRIMARY KEY AUTOINCREMENT,
     id_jogo INTEGER,
     mercado TEXT,
-    odd REAL,
-    bookmaker TEXT
+    odd REAL
 )
 """)
 
@@ -105,6 +106,9 @@ def gerar_odds_realistas(mercado):
 # --------------------------
 # Gerar dados
 # --------------------------
+jogos_batch = []
+odds_batch = []
+
 for liga_idx, (liga, times) in enumerate(LIGAS.items()):
     for temporada in TEMPORADAS:
         print(f"Gerando {liga} - {temporada}")
@@ -122,21 +126,34 @@ for liga_idx, (liga, times) in enumerate(LIGAS.items()):
             home, away = random.sample(times, 2)
             gols_home, gols_away = random.randint(0, 4), random.randint(0, 4)
 
-            # Inserir jogo
-            c.execute("""
-                INSERT INTO jogos (id_jogo, liga_nome, temporada, data, mandante, visitante, gols_mandante, gols_visitante)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (id_jogo, liga, temporada, match_date.isoformat(), home, away, gols_home, gols_away))
+            # Jogo
+            jogos_batch.append((id_jogo, liga, temporada, match_date.isoformat(),
+                                home, away, gols_home, gols_away))
 
-            # Odds
+            # Odds: uma linha por (jogo, mercado, resultado) com a melhor odd;
+            # a dimensão bookmaker não é usada pelo dashboard
             for mercado in MERCADOS:
                 odds_vals = gerar_odds_realistas(mercado)
                 for outcome, odd in odds_vals:
-                    for bookmaker in BOOKMAKERS:
-                        c.execute("""
-                            INSERT INTO odds (id_jogo, mercado, odd, bookmaker)
-                            VALUES (?, ?, ?, ?)
-                        """, (id_jogo, f"{mercado} - {outcome}", odd, bookmaker))
+                    odds_batch.append((id_jogo, f"{mercado} - {outcome}", odd))
+
+        # Inserir a temporada inteira numa única transação
+        c.execute("BEGIN")
+        c.executemany("""
+            INSERT INTO jogos (id_jogo, liga_nome, temporada, data, mandante, visitante, gols_mandante, gols_visitante)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, jogos_batch)
+        c.executemany("""
+            INSERT INTO odds (id_jogo, mercado, odd)
+            VALUES (?, ?, ?)
+        """, odds_batch)
+        conn.commit()
+        jogos_batch.clear()
+        odds_batch.clear()
+
+# Índices usados pelo dashboard (o de odds cobre MAX/AVG(odd) por jogo/mercado)
+c.execute("CREATE INDEX ix_odds_jogo_mercado ON odds(id_jogo, mercado, odd)")
+c.execute("CREATE INDEX ix_jogos_liga_temp ON jogos(liga_nome, temporada)")
 
 conn.commit()
 conn.close()
@@ -0,0 +1,16 @@
+# utils/_njit.py
+# Decorador njit com fallback: sem numba instalado, as funções rodam em Python puro.
+try:
+    from numba import njit
+    NUMBA_DISPONIVEL = True
+except ImportError:
+    NUMBA_DISPONIVEL = False
+
+    def njit(*args, **kwargs):
+        """Substituto no-op de numba.njit (aceita @njit e @njit(...))."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+        return decorator
@@ -0,0 +1,198 @@
+# utils/kernels.py
+# Kernels numéricos do backtest. Ficam fora do script do Streamlit porque o script
+# é reexecutado a cada interação e redefiniria (e recompilaria) as funções @njit.
+import numpy as np
+
+from utils._njit import njit
+
+# códigos inteiros dos mercados (o kernel não trabalha com strings)
+MT_UNKNOWN = -1
+MT_OVER_UNDER = 0
+MT_BTTS = 1
+MT_MATCH_WINNER = 2
+
+MARKET_TYPE_CODES = {
+    "over_under": MT_OVER_UNDER,
+    "btts": MT_BTTS,
+    "match_winner": MT_MATCH_WINNER,
+}
+
+SIDE_OVER = 0
+SIDE_UNDER = 1
+SIDE_YES = 0
+SIDE_NO = 1
+SIDE_HOME = 0
+SIDE_AWAY = 1
+SIDE_DRAW = 2
+
+SIDE_CODES = {
+    "Over": SIDE_OVER,
+    "Under": SIDE_UNDER,
+    "Yes": SIDE_YES,
+    "No": SIDE_NO,
+    "Home": SIDE_HOME,
+    "Away": SIDE_AWAY,
+    "Draw": SIDE_DRAW,
+}
+
+
+# --------------------------
+# Tabela de resolução das apostas
+# --------------------------
+# Cada mercado vira um código de resolução e WIN_TABLE[codigo, gols_home, gols_away]
+# diz se a aposta ganhou: o kernel troca as comparações por uma leitura na tabela.
+# Placares acima de GOLS_MAX (raros) caem na regra direta, _aposta_vencedora.
+GOLS_MAX = 15
+
+RC_BTTS_YES = 0
+RC_BTTS_NO = 1
+RC_HOME = 2
+RC_AWAY = 3
+RC_DRAW = 4
+RC_OVER_UNDER = 5  # Over/Under: RC_OVER_UNDER + 2 * linha + (0 Over | 1 Under)
+
+# gols são inteiros: "> 2.5" e "> 2" dão o mesmo resultado, então a linha
+# discretizada é floor(limit) e cada linha tem o seu próprio par de códigos.
+# Dentro da tabela a soma de gols não passa de OU_LINHA_MAX, então linhas maiores
+# usam o código de OU_LINHA_MAX sem mudar o resultado.
+OU_LINHA_MAX = 2 * GOLS_MAX
+N_RESOLUCOES = RC_OVER_UNDER + 2 * (OU_LINHA_MAX + 1)
+
+
+def market_resolution(type_code, side_code, limit):
+    """(código, linha) de um mercado já codificado: o código é a linha de WIN_TABLE
+       (-1 para mercado desconhecido) e a linha é floor(limit) sem truncar, usada
+       pela regra direta em placares fora da tabela."""
+    if type_code == MT_OVER_UNDER:
+        linha = max(int(np.floor(limit)), 0)
+        code = RC_OVER_UNDER + 2 * min(linha, OU_LINHA_MAX)
+        return code + (0 if side_code == SIDE_OVER else 1), linha
+    if type_code == MT_BTTS:
+        return (RC_BTTS_YES if side_code == SIDE_YES else RC_BTTS_NO), 0
+    if type_code == MT_MATCH_WINNER:
+        if side_code == SIDE_HOME:
+            return RC_HOME, 0
+        if side_code == SIDE_AWAY:
+            return RC_AWAY, 0
+        return RC_DRAW, 0
+    return -1, 0
+
+
+def _build_win_table():
+    gh = np.arange(GOLS_MAX + 1)[:, None]
+    ga = np.arange(GOLS_MAX + 1)[None, :]
+    table = np.zeros((N_RESOLUCOES, GOLS_MAX + 1, GOLS_MAX + 1), dtype=np.bool_)
+    table[RC_BTTS_YES] = (gh > 0) & (ga > 0)
+    table[RC_BTTS_NO] = (gh == 0) | (ga == 0)
+    table[RC_HOME] = gh > ga
+    table[RC_AWAY] = ga > gh
+    table[RC_DRAW] = gh == ga
+    gols = gh + ga
+    for linha in range(OU_LINHA_MAX + 1):
+        table[RC_OVER_UNDER + 2 * linha] = gols > linha
+        table[RC_OVER_UNDER + 2 * linha + 1] = gols <= linha
+    return table
+
+
+WIN_TABLE = _build_win_table()
+
+# odds ficam em float32 no cache; para a conta voltam a float64 arredondadas ao valor
+# cotado (2.28 e não 2.2799999713897705). 4 casas preservam médias de cotações
+ODD_CASAS = 4
+
+
+def arredondar_odds(odd):
+    """Odds float32 -> float64 arredondadas a ODD_CASAS (valor exibido/exportado)."""
+    return np.round(np.asarray(odd, dtype=np.float64), ODD_CASAS)
+
+
+@njit(inline="always")
+def _aposta_vencedora(code, linha, gols_home, gols_away):
+    # regra direta (comparações), equivalente a WIN_TABLE para qualquer placar
+    if code >= RC_OVER_UNDER:
+        gols = gols_home + gols_away
+        if (code - RC_OVER_UNDER) % 2 == 0:
+            return gols > linha
+        return gols <= linha
+    if code == RC_BTTS_YES:
+        return gols_home > 0 and gols_away > 0
+    if code == RC_BTTS_NO:
+        return gols_home == 0 or gols_away == 0
+    if code == RC_HOME:
+        return gols_home > gols_away
+    if code == RC_AWAY:
+        return gols_away > gols_home
+    return gols_home == gols_away
+
+
+@njit(cache=True, fastmath=True)
+def _simulate_kernel(odd, gh, ga, win_table, code, linha, stake, initial_bank):
+    """Resolve as apostas e acumula banca e drawdown numa única passada.
+       win_table é WIN_TABLE e (code, linha) vêm de market_resolution; placares
+       fora da tabela são resolvidos pela regra direta.
+       A conta é feita em float64 e a banca acumula em centavos inteiros, então
+       lucro/banca/drawdown saem exatos ao centavo (sem ruído de float32).
+       Retorna (lucro, banca, drawdown, wins, losses)."""
+    n = odd.shape[0]
+    lucro = np.empty(n, dtype=np.float64)
+    banca = np.empty(n, dtype=np.float64)
+    drawdown = np.empty(n, dtype=np.float64)
+    wins = 0
+    stake_c = round(stake * 100.0)
+    run_c = round(initial_bank * 100.0)
+    peak_c = run_c
+    for i in range(n):
+        h = np.int64(gh[i])
+        a = np.int64(ga[i])
+        if 0 <= h <= GOLS_MAX and 0 <= a <= GOLS_MAX:
+            win = win_table[code, h, a]
+        else:
+            win = _aposta_vencedora(code, linha, h, a)
+        if win:
+            c = round((np.float64(odd[i]) - 1.0) * stake_c)
+            wins += 1
+        else:
+            c = -stake_c
+        lucro[i] = c / 100.0
+        run_c += c
+        banca[i] = run_c / 100.0
+        # o pico parte da primeira banca, como no cummax
+        if i == 0 or run_c > peak_c:
+            peak_c = run_c
+        drawdown[i] = (run_c - peak_c) / 100.0
+    return lucro, banca, drawdown, wins, n - wins
+
+
+if __name__ == "__main__":
+    # checagem: `python -m utils.kernels` compara a resolução por tabela (incluindo
+    # placares fora dela) com a regra original por tipo/lado/limite do mercado
+    def regra_original(gh, ga, mtype, side_code, limit):
+        if mtype == MT_OVER_UNDER:
+            return gh + ga > limit if side_code == SIDE_OVER else gh + ga <= limit
+        if mtype == MT_BTTS:
+            return (gh > 0 and ga > 0) if side_code == SIDE_YES else (gh == 0 or ga == 0)
+        if side_code == SIDE_HOME:
+            return gh > ga
+        if side_code == SIDE_AWAY:
+            return ga > gh
+        return gh == ga
+
+    placares = [(h, a) for h in range(GOLS_MAX + 6) for a in range(GOLS_MAX + 6)]
+    placares += [(127, 126), (126, 127), (127, 0)]
+    gh = np.array([p[0] for p in placares], dtype=np.int8)
+    ga = np.array([p[1] for p in placares], dtype=np.int8)
+    odd = np.full(len(placares), 2.0)
+    erros = 0
+    for mtype, lados in ((MT_OVER_UNDER, (SIDE_OVER, SIDE_UNDER)),
+                         (MT_BTTS, (SIDE_YES, SIDE_NO)),
+                         (MT_MATCH_WINNER, (SIDE_HOME, SIDE_AWAY, SIDE_DRAW))):
+        for side_code in lados:
+            for limit in (0.0, 0.5, 1.5, 2.0, 2.5, 3.5, 30.5, 31.5, 40.5, 252.5, 300.0):
+                code, linha = market_resolution(mtype, side_code, limit)
+                lucro = _simulate_kernel(odd, gh, ga, WIN_TABLE, code, linha,
+                                         100.0, 0.0)[0]
+                esperado = [regra_original(int(h), int(a), mtype, side_code, limit)
+                            for h, a in placares]
+                erros += int(((lucro > 0) != np.array(esperado)).sum())
+    print("divergências:", erros)
+    raise SystemExit(1 if erros else 0)
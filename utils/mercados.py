@@ -0,0 +1,60 @@
+# utils/mercados.py
+# Interpretação dos rótulos de mercado. Fica num módulo importado para que o
+# lru_cache sobreviva às reexecuções do script do Streamlit.
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from utils.kernels import MARKET_TYPE_CODES, MT_UNKNOWN, SIDE_CODES, SIDE_NO
+
+# padrões compilados uma única vez, no import
+_OU_RE = re.compile(r"\b(?:Over|Under)\s*([0-9]+(?:\.[0-9]+)?)")
+_SIDE_RE = re.compile(r"\b(Over|Under)\b")
+_BTTS_MARKER_RE = re.compile(r"Both Teams|^BTTS", re.IGNORECASE)
+_BTTS_RE = re.compile(r"\b(Yes|No)\b", re.IGNORECASE)
+_MW_MARKER_RE = re.compile(r"Match|1X2")
+_MW_RE = re.compile(r"\b(Home|Away|Draw)\b", re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def parse_market_label(mercado_label: str):
+    """Interpreta o rótulo do mercado. O dict retornado é compartilhado pelo cache:
+       não modificar."""
+    m = mercado_label or ""
+    match = _OU_RE.search(m)
+    if match:
+        # o lado é a última ocorrência: "Over/Under 2.5 - Over" -> Over
+        side = _SIDE_RE.findall(m)[-1]
+        return {"type": "over_under", "side": side, "limit": float(match.group(1))}
+    if _BTTS_MARKER_RE.search(m):
+        match = _BTTS_RE.search(m)
+        side = match.group(1).capitalize() if match else None
+        return {"type": "btts", "side": side}
+    if _MW_MARKER_RE.search(m):
+        match = _MW_RE.search(m)
+        if match:
+            return {"type": "match_winner", "side": match.group(1).capitalize()}
+    return {"type": "unknown", "label": m}
+
+
+def encode_market(mercado_label: str):
+    """Códigos inteiros do mercado para o kernel: (type_code, side_code, limit).
+       type_code == MT_UNKNOWN indica mercado não reconhecido."""
+    parsed = parse_market_label(mercado_label)
+    type_code = MARKET_TYPE_CODES.get(parsed["type"], MT_UNKNOWN)
+    # BTTS sem lado identificado é tratado como "No" (comportamento histórico)
+    side_code = SIDE_CODES.get(parsed.get("side"), SIDE_NO)
+    return type_code, side_code, float(parsed.get("limit", 0.0))
+
+
+def encode_markets(labels) -> pd.DataFrame:
+    """Tabela (indexada por mercado) com os códigos de encode_market em tipos estreitos."""
+    labels = list(labels)
+    codes = [encode_market(m) for m in labels]
+    return pd.DataFrame({
+        "market_type_code": np.array([c[0] for c in codes], dtype=np.int8),
+        "market_side_code": np.array([c[1] for c in codes], dtype=np.int8),
+        "market_limit": np.array([c[2] for c in codes], dtype=np.float32),
+    }, index=pd.Index(labels, name="mercado"))